@@ -1,16 +1,13 @@
 #!/usr/bin/env python
 
 import argparse
-import collections
-import itertools
+import concurrent.futures
 import logging
+import mmap
+import operator
 import os
 import string
-import wave
-
-from io import BytesIO
-
-from intelhex import IntelHex
+import struct
 
 # Constants describing the image file and format of the wavetable data.
 IMAGE_SIZE_SHORT = 0x200000
@@ -21,13 +18,33 @@ WT_NAME_LENGTH = 8
 WT_NAME_PREFIX = b'  '
 WT_USER_NAME_LENGTH = WT_NAME_LENGTH - len(WT_NAME_PREFIX)
 ALLOWED_CHARS = string.ascii_letters + string.digits + ' '  # characters allowed in wt names
+ALLOWED_BYTES = ALLOWED_CHARS.encode()
 WT_DATA_OFFSET = 0x100000
 WT_DATA_LENGTH = 1024 * 8  # 512 16 bit unsigned ints per wave, 8 waves per table
 
+# Header for a wav file holding one wavetable as mono 16 bit audio. The tables are all the same size, so it never
+# changes.
+WAV_SAMPLE_RATE = 44100
+WAV_HEADER = struct.pack(
+    '<4sI4s4sIHHIIHH4sI',
+    b'RIFF', 36 + WT_DATA_LENGTH, b'WAVE',
+    b'fmt ', 16, 1, 1, WAV_SAMPLE_RATE, WAV_SAMPLE_RATE * 2, 2, 16,
+    b'data', WT_DATA_LENGTH
+)
+
+# Intel HEX record types and the number of data bytes written per data record.
+IHEX_DATA = 0x00
+IHEX_END_OF_FILE = 0x01
+IHEX_EXTENDED_LINEAR_ADDRESS = 0x04
+IHEX_RECORD_LENGTH = 16
+
 # Consecutive identical values permitted in the wavetable audio data. This particular value is chosen because a
 # couple waves in a row with a static value are conceivably useful.
 RUN_LIMIT = WT_DATA_LENGTH // 4
 
+# Number of threads used to read wavetable files from disk.
+READ_WORKERS = 8
+
 
 class SSPatcherError(Exception):
     pass
@@ -36,7 +53,7 @@ class SSPatcherError(Exception):
 def read_wt_data(f):
     """Given an open file containing the shapeshifter rom image, extract the wavetable audio data.
 
-    :param f: File handle for the shapeshifter rom image.
+    :param f: File handle or mmap for the shapeshifter rom image.
     :return: List of bytes containing the wavetable audio data.
     """
     # Retrieve the wavetable audio data.
@@ -48,21 +65,31 @@ def read_wt_data(f):
 
     # The WT data is effectively random ints, but the EEPROM image has many long runs of identical values in
     # unused space. Use this fact to sanity check that the data at least looks legitimate.
-    for byte, run in itertools.groupby(wt_data_block):
-        length = len(list(run))
-        if length > RUN_LIMIT:
-            # For testing convenience, throw the run length in as an extra argument to the exception.
-            raise SSPatcherError(
-                'Found a run of {0} characters ({1}); wavetable data looks invalid.'.format(length, byte),
-                length
-            )
+    # For each byte value present, search for it repeated RUN_LIMIT + 1 times; the first hit is where the value's
+    # first long run starts. Each search is a linear scan in C, and once a run is found later searches only need to
+    # look before it.
+    run_start = None
+    for value in set(wt_data_block):
+        long_run = bytes((value,)) * (RUN_LIMIT + 1)
+        search_end = data_block_length if run_start is None else run_start + RUN_LIMIT
+        found = wt_data_block.find(long_run, 0, search_end)
+        if found != -1:
+            run_start, byte = found, value
+    if run_start is not None:
+        run = wt_data_block[run_start:]
+        length = len(run) - len(run.lstrip(bytes((byte,))))
+        # For testing convenience, throw the run length in as an extra argument to the exception.
+        raise SSPatcherError(
+            'Found a run of {0} characters ({1}); wavetable data looks invalid.'.format(length, byte),
+            length
+        )
     return [wt_data_block[i:i + WT_DATA_LENGTH] for i in range(0, data_block_length, WT_DATA_LENGTH)]
 
 
 def read_wt_names(f):
     """ Given an open file containing the shapeshifter rom image, extract the wavetable names.
 
-    :param f: File handle for the shapeshifter rom image.
+    :param f: File handle or mmap for the shapeshifter rom image.
     :return: List of bytes containing the wavetable names.
     """
     # Retrieve the names of the wavetables.
@@ -71,80 +98,115 @@ def read_wt_names(f):
     wt_name_block = f.read(name_block_length)
     if len(wt_name_block) != name_block_length:
         raise SSPatcherError('Got less than {} bytes when reading wavetable names.'.format(name_block_length))
-    wt_names = [
-        wt_name_block[i:i + WT_NAME_LENGTH]
-        for i in range(0, name_block_length, WT_NAME_LENGTH)
-    ]
 
     # Sanity check: if we got the right data, the wavetable names should have the prefix specified in the
-    # Shapeshifter documentation.
-    for name in wt_names:
-        if not name.startswith(WT_NAME_PREFIX):
-            raise SSPatcherError('Found wavetable name ({}) without valid prefix.'.format(name))
+    # Shapeshifter documentation. A stepped slice picks out the same character position of every name at once, so
+    # each prefix character is checked for all the names in a single comparison.
+    bad = NUM_WT
+    for i, ch in enumerate(WT_NAME_PREFIX):
+        expected = bytes([ch])
+        column = wt_name_block[i::WT_NAME_LENGTH]
+        if column != expected * NUM_WT:
+            bad = min(bad, NUM_WT - len(column.lstrip(expected)))
+    if bad < NUM_WT:
+        name = wt_name_block[bad * WT_NAME_LENGTH:(bad + 1) * WT_NAME_LENGTH]
+        raise SSPatcherError('Found wavetable name ({}) without valid prefix.'.format(name))
 
     # Strip the prefix from the names returned for easy handling. It can be added back when patching the image.
-    return [name[len(WT_NAME_PREFIX):] for name in wt_names]
-
+    return [
+        wt_name_block[i + len(WT_NAME_PREFIX):i + WT_NAME_LENGTH]
+        for i in range(0, name_block_length, WT_NAME_LENGTH)
+    ]
 
-def _get_index_from_filename(wt):
-    name = wt[0]
 
+def _split_prefixed_name(name):
+    # Split a "<index>_<name>" filename, as used with --sortprefix, into its integer index and stripped name.
     try:
-        i, _ = name.split('_', 1)
+        i, name_part = name.split('_', 1)
+        return int(i), name_part.strip()
     except ValueError:
-        raise SSPatcherError("--sortprefix flag given, but {} seems to not be formatted".format(name)) 
-    
-    return int(i)
+        raise SSPatcherError("--sortprefix flag given, but {} seems to not be formatted".format(name))
+
+
+def _scan_wavetable_files(path, subdirs=True):
+    # scandir gets the file type from the directory listing itself, so nothing but the wavetable files needs a stat.
+    # Hidden entries (.DS_Store, .Trashes, ...) are skipped. The only subdirectories searched are the numbered ones
+    # extract writes with subdirs, one level down and not through symlinks, so other directories on an SD card are
+    # left alone.
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if subdirs and entry.name.isdigit():
+                    yield from _scan_wavetable_files(entry.path, subdirs=False)
+            elif entry.is_file():
+                yield entry
+
+
+def _read_wavetable_file(entry):
+    # Strip the extension by hand rather than with os.path.splitext. As with splitext, dots at the start of the name
+    # don't start an extension.
+    name = entry.name
+    dot = name.rfind('.')
+    if dot > 0 and name[:dot].strip('.'):
+        name = name[:dot]
+    # The files are small and read whole, so skip the buffered IO layer.
+    with open(entry.path, 'rb', buffering=0) as f:
+        return name, f.read()
 
 
-def _get_name_from_filename(name):
-    try:
-        _, name = name.split('_', 1)
-    except ValueError:
-        raise SSPatcherError("--sortprefix flag given, but {} seems to not be formatted".format(name)) 
-    
-    return name.strip()
-
 def read_wavetables_from_files(path, is_prefixed=False):
     """Read wavetable data from files and infer wavetable names from the filenames.
 
-    :param path: String path to the directory where the files are located.
+    :param path: String path to the directory where the files are located. Files in the numbered subdirectories
+                 written by extract with subdirs are included.
     :param is_prefixed: Boolean key for whether or not wavetable names are prefixed with sorting info.
-    :return: Ordered dict where keys are bytes containing the names of length WT_USER_NAME_LENGTH and values are bytes
-             of length WT_DATA_LENGTH containing audio data.
+    :return: Dict, in wavetable order, where keys are bytes containing the names of length WT_USER_NAME_LENGTH and
+             values are bytes of length WT_DATA_LENGTH containing audio data.
     """
     if not os.path.isdir(path):
         raise SSPatcherError("'{} doesn't exist or isn't a directory; aborting.".format(path))
 
+    entries = list(_scan_wavetable_files(path))
+
+    # Reading is I/O bound and the GIL is released during reads, so threads overlap the per-file latency.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+        results = list(executor.map(_read_wavetable_file, entries))
+
     # Build the dictionary
     wavetables = {}
-    for wt_file in os.listdir(path):
-        if wt_file == ".DS_Store":
-            continue
-        
-        with open(os.path.join(path, wt_file), 'rb') as f:
-            name = os.path.splitext(wt_file)[0]
-
-            data = f.read()
-            if name in wavetables:
-                raise SSPatcherError('Duplicate name "{}" in wavetable names.'.format(name))
-            if len(data) != WT_DATA_LENGTH:
-                raise SSPatcherError(
-                    'Wavetable {} was the wrong size (expected {}, got {}).'.format(name, WT_DATA_LENGTH, len(data))
-                )
-            wavetables[name] = data
+    for name, data in results:
+        if name in wavetables:
+            raise SSPatcherError('Duplicate name "{}" in wavetable names.'.format(name))
+        if len(data) != WT_DATA_LENGTH:
+            raise SSPatcherError(
+                'Wavetable {} was the wrong size (expected {}, got {}).'.format(name, WT_DATA_LENGTH, len(data))
+            )
+        wavetables[name] = data
 
     if is_prefixed:
-        wavetables = {sanitize_name(_get_name_from_filename(name)): data for name, data in sorted(wavetables.items(), key=_get_index_from_filename)}
+        # Parse each filename once, then sort on the index that was parsed out.
+        prefixed = [_split_prefixed_name(name) + (data,) for name, data in wavetables.items()]
+        prefixed.sort(key=operator.itemgetter(0))
+        ordered = [(name, data) for _, name, data in prefixed]
     else:
-        wavetables = {sanitize_name(name): data for name, data in sorted(wavetables.items(), key=lambda item: item[0].strip())}
+        # Names can be padded with spaces on the left, so strip whitespace when sorting.
+        ordered = sorted(wavetables.items(), key=lambda item: item[0].strip())
+
+    # Different filenames can sanitize to the same name, e.g. when they only differ in characters truncated away.
+    wavetables = {}
+    for name, data in ordered:
+        name = sanitize_name(name)
+        if name in wavetables:
+            raise SSPatcherError('Duplicate name "{}" in wavetable names.'.format(name.decode()))
+        wavetables[name] = data
 
     # Basic sanity checking is done while building the dict, but make sure we also got the right number of wavetables
     if len(wavetables) != NUM_WT:
         raise SSPatcherError('Found wrong number of wavetables (expected {}, got {}).'.format(NUM_WT, len(wavetables)))
 
-    # Return a sorted dict - can be padded with spaces on the left, so strip whitespace when sorting.
-    return collections.OrderedDict(wavetables.items())
+    return wavetables
 
 
 def check_image_size(filename):
@@ -152,42 +214,63 @@ def check_image_size(filename):
 
     :param filename: String path to the shapeshifter rom image.
     """
-    if os.path.getsize(filename) != IMAGE_SIZE_SHORT and os.path.getsize(filename) != IMAGE_SIZE_LONG:
+    size = os.path.getsize(filename)
+    if size not in (IMAGE_SIZE_SHORT, IMAGE_SIZE_LONG):
         raise SSPatcherError(
             'Shapeshifter ROM image ({}) had unexpected size (got {}, expected {} or {}).'.format(
-                filename, os.path.getsize(filename), IMAGE_SIZE_SHORT, IMAGE_SIZE_LONG
+                filename, size, IMAGE_SIZE_SHORT, IMAGE_SIZE_LONG
             )
         )
 
 
-def extract(source, destination):
+def extract(source, destination, subdirs=None):
     """Extract wavetables from a file containing the shapeshifter ROM image and write them to individual files.
 
+    If subdirs is given, the files are split in image order across that many numbered subdirectories of destination
+    (00, 01, ...) rather than all written to destination itself. Keeping directories small helps on filesystems like
+    FAT32 where lookups in a directory with many entries touch many blocks.
+
     :param source: String path to the shapeshifter rom image.
-    :param destination: String path to the directory to put the individual wavetable files in.
+    :param destination: String path to the directory to put the individual wavetable files in. Wav versions of the
+                        files are written to a directory of the same name with '_wav' appended.
+    :param subdirs: Optional number of subdirectories to split the wavetable files between. Must divide NUM_WT evenly
+                    so that every subdirectory gets the same number of files.
     """
+    if subdirs is not None and not (1 <= subdirs <= NUM_WT and NUM_WT % subdirs == 0):
+        raise SSPatcherError(
+            'Number of subdirectories must be between 1 and {} and divide it evenly (got {}).'.format(NUM_WT, subdirs)
+        )
     check_image_size(source)
-    if os.path.exists(destination):
-        raise SSPatcherError("{} already exists; aborting so existing data isn't overwritten.".format(destination))
-    else:
-        os.mkdir(destination)
-    with open(source, 'rb') as f:
-        names = read_wt_names(f)
-        tables = read_wt_data(f)
+    # Wav copies of the tables are handy for listening to them. They go in a separate directory so that destination
+    # can still be used as-is for patching.
+    wav_directory = os.path.normpath(destination) + '_wav'
+    for directory in (destination, wav_directory):
+        if os.path.exists(directory):
+            raise SSPatcherError("{} already exists; aborting so existing data isn't overwritten.".format(directory))
+    os.mkdir(destination)
+    os.mkdir(wav_directory)
+    # Map the image rather than reading it through the file object; the blocks are read straight out of the page cache.
+    with open(source, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        names = read_wt_names(mm)
+        tables = read_wt_data(mm)
     if not len(names) == len(tables) == NUM_WT:
         raise SSPatcherError('Wavetable name/data had unexpected length (names:{}, tables:{}, expected:{}).'.format(
             len(names), len(tables), NUM_WT
         ))
-    for name, table in zip(names, tables):
-        # write wavs for testing
-        new_wav = "{}/{}.wav".format("test_wavs", name)
-        with wave.open(new_wav, mode="wb") as f_out:
-            f_out.setnchannels(1)
-            f_out.setsampwidth(2)
-            f_out.setframerate(44100)
-            f_out.writeframes(table)
-
-        with open(os.path.join(destination, name.decode() + '.raw'), 'wb') as f:
+    if subdirs is None:
+        directories = [destination] * NUM_WT
+    else:
+        tables_per_dir = NUM_WT // subdirs
+        directories = [os.path.join(destination, '{:02d}'.format(i // tables_per_dir)) for i in range(NUM_WT)]
+        for directory in sorted(set(directories)):
+            os.mkdir(directory)
+    for name, table, directory in zip(names, tables, directories):
+        name = name.decode()
+        with open(os.path.join(wav_directory, name + '.wav'), 'wb') as f:
+            f.write(WAV_HEADER)
+            f.write(table)
+
+        with open(os.path.join(directory, name + '.raw'), 'wb') as f:
             f.write(table)
 
 
@@ -203,16 +286,18 @@ def sanitize_name(name):
     log = logging.getLogger('sspatcher')
     if len(name) > WT_USER_NAME_LENGTH:
         # Use the last 6 characters since this is maybe less likely to cause collisions than the first 6.
-        new_name = name.strip()[-6:]
+        new_name = name.strip()[-WT_USER_NAME_LENGTH:]
         log.warn('Filename "{}" was too long. Renamed to "{}".'.format(name, new_name))
         name = new_name
     # It's possible the name is too short now, due to stripping whitespace.
-    if len(name) < WT_USER_NAME_LENGTH:
-        name = name.rjust(6)
-    for ch in name:
-        if ch not in ALLOWED_CHARS:
-            raise SSPatcherError('Wavetable name ({}) contains invalid character ({}).'.format(name, ch))
-    return name.encode()
+    name = name.rjust(WT_USER_NAME_LENGTH)
+    # Characters that aren't ASCII are encoded as '?', which isn't allowed either, so deleting every allowed byte from
+    # the encoded name leaves something exactly when the name has an invalid character.
+    encoded = name.encode('ascii', 'replace')
+    if encoded.translate(None, ALLOWED_BYTES):
+        ch = next(ch for ch in name if ch not in ALLOWED_CHARS)
+        raise SSPatcherError('Wavetable name ({}) contains invalid character ({}).'.format(name, ch))
+    return encoded
 
 
 def patch(source, destination):
@@ -226,18 +311,68 @@ def patch(source, destination):
     names = data.keys()
     wavetables = data.values()
 
-    # Patch the ROM
-    with open(destination, 'r+b') as f:
-        name_data = WT_NAME_PREFIX + WT_NAME_PREFIX.join(names)
-        f.seek(WT_NAME_OFFSET)
-        f.write(name_data)
+    # Patch the ROM. Each name and wavetable is copied straight into its slot in the mapped image, so the blocks are
+    # never joined into intermediate buffers.
+    with open(destination, 'r+b') as f, mmap.mmap(f.fileno(), 0) as mm:
+        for i, name in enumerate(names):
+            start = WT_NAME_OFFSET + i * WT_NAME_LENGTH
+            mm[start:start + len(WT_NAME_PREFIX)] = WT_NAME_PREFIX
+            mm[start + len(WT_NAME_PREFIX):start + WT_NAME_LENGTH] = name
+
+        for i, wavetable in enumerate(wavetables):
+            start = WT_DATA_OFFSET + i * WT_DATA_LENGTH
+            mm[start:start + WT_DATA_LENGTH] = wavetable
+        mm.flush()
+
+
+def _ihex_record(address, record_type, data=b''):
+    # One line of an Intel HEX file: ':', then length, 16 bit address, type, data and checksum as uppercase hex. The
+    # checksum is appended before converting so the whole record goes through a single hex() call.
+    record = bytearray((len(data), (address >> 8) & 0xFF, address & 0xFF, record_type))
+    record += data
+    record.append(-sum(record) & 0xFF)
+    return ':' + record.hex().upper() + '\n'
+
+
+def _ihex_records(data, offset):
+    # Generate the records one at a time so writelines streams them out rather than holding the whole file in memory.
+    end = offset + len(data)
+    use_extended_address = end - 1 > 0xFFFF
+    address = offset
+    while address < end:
+        if use_extended_address:
+            yield _ihex_record(0, IHEX_EXTENDED_LINEAR_ADDRESS, (address >> 16).to_bytes(2, 'big'))
+        segment_end = min(end, (address | 0xFFFF) + 1)
+        for record_start in range(address, segment_end, IHEX_RECORD_LENGTH):
+            record_end = min(record_start + IHEX_RECORD_LENGTH, segment_end)
+            yield _ihex_record(record_start, IHEX_DATA, data[record_start - offset:record_end - offset])
+        address = segment_end
+    yield _ihex_record(0, IHEX_END_OF_FILE)
+
+
+def _write_ihex(out, data, offset):
+    """Write a block of data to a file in Intel HEX format.
+
+    The records are streamed straight from the data, laid out the same way intelhex's write_hex_file lays them out:
+    up to IHEX_RECORD_LENGTH bytes per data record, with an extended linear address record at the start of each
+    64 KB segment when addresses don't fit in 16 bits.
+
+    :param out: File handle opened for writing text.
+    :param data: Bytes to write.
+    :param offset: Integer address that the first byte of data is loaded at.
+    """
+    out.writelines(_ihex_records(memoryview(data), offset))
 
-        wt_data = b''.join(wavetables)
-        f.seek(WT_DATA_OFFSET)
-        f.write(wt_data)
 
 def derive_names(source, is_prefixed=False):
+    """Write the names and wavetables found in a source directory to Intel HEX files for merging with a .sof file.
 
+    The names are written to <source>_names.hex and the wavetable audio data to <source>_waves.hex, each at the
+    address where it lives in the shapeshifter ROM image.
+
+    :param source: String path to the directory where the wavetables are found.
+    :param is_prefixed: Boolean key for whether or not wavetable names are prefixed with sorting info.
+    """
     data = read_wavetables_from_files(source, is_prefixed=is_prefixed)
     names = data.keys()
     wavetables = data.values()
@@ -245,25 +380,11 @@ def derive_names(source, is_prefixed=False):
     name_data = WT_NAME_PREFIX + WT_NAME_PREFIX.join(names)
     wt_data = b''.join(wavetables)
 
-    # names
-    in_f = BytesIO(name_data)
-
-    ih = IntelHex()
-    ih.loadbin(in_f, offset=WT_NAME_OFFSET)
+    with open(source + '_names.hex', 'w') as f:
+        _write_ihex(f, name_data, WT_NAME_OFFSET)
 
-    out_f = open(source + '_names.hex', 'w')
-    ih.write_hex_file(out_f)
-    out_f.close()
-
-    # waves
-    in_f = BytesIO(wt_data)
-
-    ih = IntelHex()
-    ih.loadbin(in_f, offset=WT_DATA_OFFSET)
-
-    out_f = open(source + '_waves.hex', 'w')
-    ih.write_hex_file(out_f)
-    out_f.close()
+    with open(source + '_waves.hex', 'w') as f:
+        _write_ihex(f, wt_data, WT_DATA_OFFSET)
 
 
 if __name__ == '__main__':
@@ -283,10 +404,18 @@ if __name__ == '__main__':
     parser.add_argument('-d',
         '--directory',
         nargs='?',
-        help="Directory where extracted wavetable data will be written. If it doesn't exist, it will be created. "
-             "Default: %(default)s",
+        help="Directory where extracted wavetable data will be written. It must not already exist, and will be "
+             "created. Wav copies of the wavetables are written to a directory of the same name with '_wav' "
+             "appended. Default: %(default)s",
         default='sstables'
     )
+    parser.add_argument(
+        '--subdirs',
+        type=int,
+        metavar='N',
+        help='When extracting, split the wavetable files between N numbered subdirectories of the directory. N must '
+             'divide 128 evenly (1, 2, 4, ..., 128).'
+    )
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('-e', '--extract', help='Extract wavetables from the image.', action='store_true')
     group.add_argument('-p', '--patch', help='Patch the image file with new wavetables.', action='store_true')
@@ -296,7 +425,7 @@ if __name__ == '__main__':
     # Perform the user's requested action - exceptions are caught to provide less intimidating error messaging.
     try:
         if args.extract:
-            extract(args.image, args.directory)
+            extract(args.image, args.directory, subdirs=args.subdirs)
             print("Successfully extracted wavetables from {} and put them in {}.".format(args.image, args.directory))
         elif args.patch:
             patch(args.directory, args.image)
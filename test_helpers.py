@@ -0,0 +1,121 @@
+import contextlib
+import functools
+import os
+import tempfile
+
+import sspatcher
+
+# Fixture files go on a RAM-backed filesystem where there is one, so tests writing hundreds of them don't wait on the
+# disk. Elsewhere the default temporary directory is used.
+TEMP_ROOT = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+@functools.lru_cache(maxsize=4)
+def _cached_parse(path, mtime, size, name_offset, data_offset):
+    # The offsets aren't used here, but read_wt_names and read_wt_data read from them, so they're part of the key.
+    with open(path, 'rb') as f:
+        return tuple(sspatcher.read_wt_names(f)), tuple(sspatcher.read_wt_data(f))
+
+
+def parse_image(path):
+    """Read the wavetable names and audio data from a ROM image, reusing earlier results for the same file.
+
+    The cache is keyed on the file's modification time and size as well as its path, so a changed file is read again,
+    and on the current name and audio data offsets, so reads inside sspatcher_offsets get their own results.
+
+    :return: Tuple of (names, tables), each a tuple of bytes.
+    """
+    stat = os.stat(path)
+    return _cached_parse(path, stat.st_mtime_ns, stat.st_size, sspatcher.WT_NAME_OFFSET, sspatcher.WT_DATA_OFFSET)
+
+
+@contextlib.contextmanager
+def sspatcher_offsets(name=None, data=None):
+    """Temporarily read wavetable names and/or audio data from other locations in the image.
+
+    The offsets are put back when the with block exits, even if it raises.
+
+    :param name: Offset to use for WT_NAME_OFFSET, or None to leave it as it is.
+    :param data: Offset to use for WT_DATA_OFFSET, or None to leave it as it is.
+    """
+    old_name, old_data = sspatcher.WT_NAME_OFFSET, sspatcher.WT_DATA_OFFSET
+    if name is not None:
+        sspatcher.WT_NAME_OFFSET = name
+    if data is not None:
+        sspatcher.WT_DATA_OFFSET = data
+    try:
+        yield
+    finally:
+        sspatcher.WT_NAME_OFFSET, sspatcher.WT_DATA_OFFSET = old_name, old_data
+
+
+def parse_ihex(text):
+    """Read back the data from Intel HEX text, checking each record's checksum as it goes.
+
+    Only the record types sspatcher writes are handled: data, end of file and extended linear address. The data records
+    must be contiguous.
+
+    :param text: String containing the Intel HEX records, one per line.
+    :return: Tuple of (integer address of the first data byte, bytes containing the data).
+    """
+    start, data, upper_address = None, bytearray(), 0
+    lines = text.splitlines()
+    for line_number, line in enumerate(lines):
+        if not line.startswith(':') or line != line.upper():
+            raise ValueError('Malformed record ({}).'.format(line))
+        record = bytes.fromhex(line[1:])
+        if sum(record) & 0xFF:
+            raise ValueError('Bad checksum in record ({}).'.format(line))
+        length, address, record_type, payload = record[0], int.from_bytes(record[1:3], 'big'), record[3], record[4:-1]
+        if len(payload) != length:
+            raise ValueError('Record ({}) has the wrong length.'.format(line))
+        if record_type == sspatcher.IHEX_EXTENDED_LINEAR_ADDRESS:
+            upper_address = int.from_bytes(payload, 'big') << 16
+        elif record_type == sspatcher.IHEX_DATA:
+            if start is None:
+                start = upper_address | address
+            elif upper_address | address != start + len(data):
+                raise ValueError('Record ({}) is not contiguous with the data before it.'.format(line))
+            data += payload
+        elif record_type == sspatcher.IHEX_END_OF_FILE:
+            if line_number != len(lines) - 1:
+                raise ValueError('End of file record is not the last record.')
+            return start, bytes(data)
+        else:
+            raise ValueError('Unexpected record type ({}).'.format(record_type))
+    raise ValueError('No end of file record.')
+
+
+def write_file(path, data):
+    """Create or overwrite a file containing data, without going through a buffered file object."""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+class RandomTablesMixin:
+    """Mixin for test cases that write wavetable files full of random data.
+
+    The random data is drawn once per class and handed out in slices, rather than calling os.urandom for every file.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.random_data = memoryview(os.urandom(sspatcher.WT_DATA_LENGTH * sspatcher.NUM_WT * 2))
+
+    def random_table(self, i):
+        """Return the i-th wavetable's worth of random data."""
+        return self.random_data[i * sspatcher.WT_DATA_LENGTH:(i + 1) * sspatcher.WT_DATA_LENGTH]
+
+
+class TempDirMixin:
+    """Mixin giving each test its own empty directory, self.temp_dir, which is removed after the test."""
+
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.TemporaryDirectory(dir=TEMP_ROOT)
+        self.addCleanup(temp_dir.cleanup)
+        self.temp_dir = temp_dir.name
@@ -1,67 +1,133 @@
-import functools
+import io
 import itertools
 import os
 import random
+import re
 import shutil
 import sspatcher
 import string
 import unittest
+import wave
+
+from test_helpers import RandomTablesMixin, TempDirMixin, parse_ihex, parse_image, sspatcher_offsets, write_file
 
 
 # Constants for locations of test data
-TEMP_DIRECTORY = 'test_tables'
 READ_TEST_LOCATION = 'test_read'
 REAL_TEST_IMAGE_PATH = 'shapeshifter_test.bin'
 
+MAX_UNICODE_CHAR = 0x10FFFF
+
+# Compiled once for the tests that check many rejected names; assertRaisesRegex only compiles patterns given as strings.
+INVALID_CHARACTER_PATTERN = re.compile('invalid character')
+
+# Factory wavetable names, in image order. First copied from the Shapeshifter manual, then adjusted to the names
+# actually present in the factory image which use a couple different styles of padding with spaces to
+# make all names exactly 8 characters.
+FACTORY_NAMES = (
+    b"Basic1", b"Basic2", b"BasRec", b"BiPuls", b"BitCr1", b"BitCr2", b"BitCr3", b"BitCr4",
+    b"Buzzer", b"Cello1", b"Cello2", b"Chip 1", b"Chip 2", b"Chip 3", b"Chip 4", b"Chip 5",
+    b"Chip 6", b"Chirp1", b"Chirp2", b"Chirp3", b"Chirp4", b"Chirp5", b"Chirp6", b"Chirp7",
+    b"Chirp8", b"Chirp9", b"Chrp10", b"Chrp11", b"Chrp12", b"Chrp13", b"Chrp14", b"Chrp15",
+    b"Chrp16", b"Chrp17", b"Chrp18", b"Chrp19", b"Chrp20", b"Clrnet", b" Clav1", b" Clav2",
+    b"Dstrt1", b"Dstrt2", b"Dstrt3", b"eBass1", b"eBass2", b"eBass3", b"eBass4", b"ePian1",
+    b"ePian2", b"ePian3", b"ePian4", b"ePian5", b"Flute1", b"GapSaw", b"Grain1", b"Grain2",
+    b"Grain3", b"Gitar1", b"Gitar2", b"Gitar3", b"Gitar4", b"Harmo1", b"Harmo2", b"Harmo3",
+    b"  LFO1", b"  LFO2", b"  LFO3", b"  LFO4", b"  LFO5", b"  LFO6", b"  LFO7", b"  LFO8",
+    b"  LFO9", b" LFO10", b" LFO11", b" LFO12", b" LFO13", b" LFO14", b" LFO15", b" LFO16",
+    b" LFO17", b" LFO18", b" LFO19", b" LFO20", b" LFO21", b" Misc1", b" Misc2", b" Misc3",
+    b" Misc4", b"Noise1", b"Noise2", b"Noise3", b"Noise4", b"Noise5", b"Noise6", b" Oboes",
+    b"Ovrto1", b"Ovrto2", b"Raw  1", b"Raw  2", b"Raw  3", b"ResPls", b"ResSaw", b"ResSqu",
+    b"Saxoph", b"Symmtr", b"Thrmin", b"2Tone1", b"2Tone2", b"2Tone3", b"2Tone4", b"2Tone5",
+    b"2Tone6", b"2Tone7", b"2Tone8", b"2Tone9", b"VidGm1", b"VidGm2", b"VidGm3", b"VidGm4",
+    b"Violin", b"Vocal1", b"Vocal2", b"Vocal3", b"Vocal4", b"Vocal5", b"Vocal6", b"Vocal7"
+)
+
+# Every valid name character, in space-padded chunks of one wavetable name each. This builds the list of valid
+# characters the same way the sspatcher constant does, so test_valid_chars should really never fail unless something is
+# horribly wrong or the constant changes.
+VALID_NAME_CHUNKS = tuple(
+    ''.join(chunk) for chunk in itertools.zip_longest(
+        *[iter(string.ascii_letters + string.digits + ' ')] * sspatcher.WT_USER_NAME_LENGTH, fillvalue=' '
+    )
+)
+
 
 class TestReadWTData(unittest.TestCase):
     """Tests for read_wt_data."""
 
-    def setUp(self):
-        self.old_name_offset = sspatcher.WT_NAME_OFFSET
-        self.old_data_offset = sspatcher.WT_DATA_OFFSET
-        self.test_image = open(REAL_TEST_IMAGE_PATH, 'rb')
+    @classmethod
+    def setUpClass(cls):
+        # Read the image once; each test gets its own in-memory file over the same bytes.
+        with open(REAL_TEST_IMAGE_PATH, 'rb') as f:
+            cls.image_bytes = f.read()
 
-    def tearDown(self):
-        sspatcher.WT_NAME_OFFSET = self.old_name_offset
-        sspatcher.WT_DATA_OFFSET = self.old_data_offset
-        self.test_image.close()
+    def setUp(self):
+        self.test_image = io.BytesIO(self.image_bytes)
+        self.addCleanup(self.test_image.close)
 
     def test_exceptions_from_known_bad_data_locations(self):
         """Correct exceptions are raised when reading audio data from locations known to cause them."""
-        sspatcher.WT_DATA_OFFSET = 0x0AF6B0  # First offset in factory image with long runs of identical bytes
-        with self.assertRaisesRegex(
+        # First offset in factory image with long runs of identical bytes
+        with sspatcher_offsets(data=0x0AF6B0), self.assertRaisesRegex(
                 sspatcher.SSPatcherError,
-                'Found a run of .+ characters .+; wavetable data looks invalid\.',
+                r'Found a run of .+ characters .+; wavetable data looks invalid\.',
                 msg="Read from known location where audio data doesn't exist didn't raise SSPatcherError."
         ):
             sspatcher.read_wt_data(self.test_image)
 
-        sspatcher.WT_DATA_OFFSET = sspatcher.IMAGE_SIZE - 64
-        with self.assertRaisesRegex(
+        with sspatcher_offsets(data=len(self.image_bytes) - 64), self.assertRaisesRegex(
                 sspatcher.SSPatcherError,
-                'Got less than .+ bytes when reading wavetable audio data\.',
+                r'Got less than .+ bytes when reading wavetable audio data\.',
                 msg="Read from known location where insufficient audio data can be read didn't raise SSPatcherError."
         ):
             sspatcher.read_wt_data(self.test_image)
 
-    def test_various_bad_data_locations(self):
+    def test_bad_data_locations(self):
+        """SSPatcherError is raised when reading audio data from locations other than where the wavetables are.
+
+        Sweeping the whole image takes most of a minute, so this checks a fixed random sample of locations plus the
+        start and end of the image and each boundary between audio-data-sized blocks. As in the full sweep, locations
+        just before the real one look valid and are left out, as are those less than a wavetable after it, which read
+        mostly real audio data.
+        """
+        data_offset = sspatcher.WT_DATA_OFFSET
+        image_size = len(self.image_bytes)
+        data_block_length = sspatcher.WT_DATA_LENGTH * sspatcher.NUM_WT
+        rng = random.Random(0xD00D)
+        offsets = set(rng.sample(range(image_size), 64))
+        offsets |= set(range(0, image_size, data_block_length))
+        offsets |= {1, image_size - data_block_length, image_size - data_block_length + 1, image_size - 1}
+        skip_start, skip_end = 0xFF800, data_offset + sspatcher.WT_DATA_LENGTH
+        for i in sorted(offsets):
+            if not skip_start <= i < skip_end:
+                with sspatcher_offsets(data=i), self.assertRaises(
+                        sspatcher.SSPatcherError,
+                        msg='Read audio data from location {:X} did not raise an SSPatcherError.'.format(i)
+                ):
+                    sspatcher.read_wt_data(self.test_image)
+
+    @unittest.skipUnless(os.environ.get('SLOW_TESTS'), 'set SLOW_TESTS to check every location')
+    def test_all_bad_data_locations(self):
         """SSPatcherError is raised when reading audio data from various invalid locations.
 
         This test is a little fuzzy since the determination of whether valid audio data was found is itself inexact.
+        It's expected to take most of a minute since it tries to read from every location, skipping ahead past runs.
         """
         # Since checking for invalid audio data involves looking for runs of consecutive values deemed too long
         # the locations immediately preceding the valid audio data in the image cause false positives. So, those
         # locations will be skipped in the test.
-        first_false_positive_location = 0xFF800
+        # +1 here to include the known valid audio data location in what is skipped.
+        skip_start, skip_end = 0xFF800, sspatcher.WT_DATA_OFFSET + 1
+        # Looked up once rather than on every one of the (up to) image size iterations.
+        image_size, run_limit = len(self.image_bytes), sspatcher.RUN_LIMIT
         passed = False
         i = 0
-        while i < sspatcher.IMAGE_SIZE:
-            # +1 here to include the known valid audio data location in what is skipped.
-            if i not in range(first_false_positive_location, self.old_data_offset + 1):
-                sspatcher.WT_DATA_OFFSET = i
+        while i < image_size:
+            if not skip_start <= i < skip_end:
                 try:
-                    sspatcher.read_wt_data(self.test_image)
+                    with sspatcher_offsets(data=i):
+                        sspatcher.read_wt_data(self.test_image)
                 except sspatcher.SSPatcherError as exception:
                     try:
                         run_length = exception.args[1]
@@ -70,7 +136,7 @@ class TestReadWTData(unittest.TestCase):
                             # very slow if this isn't done since the audio data is ~1 megabyte.
                             # -1 here because it will be added back later; avoids having a bunch of else branches to
                             # add 1.
-                            i += run_length - sspatcher.RUN_LIMIT - 1
+                            i += run_length - run_limit - 1
                     except IndexError:  # Exception wasn't due to a long run of identical values
                         pass
                     if exception.args[0].startswith('Got less than'):
@@ -85,51 +151,108 @@ class TestReadWTData(unittest.TestCase):
         """Something that looks like good audio data is extracted from the factory image."""
         # It might be nice to check that the extracted waves match some reference file, but we don't have that for
         # the factory waves, so just make sure we got the right number of wavetables and that they are the right size.
-        wavetables = sspatcher.read_wt_data(self.test_image)
+        _, wavetables = parse_image(REAL_TEST_IMAGE_PATH)
         self.assertEqual(len(wavetables), sspatcher.NUM_WT)
         for wavetable in wavetables:
             self.assertEqual(len(wavetable), sspatcher.WT_DATA_LENGTH)
 
+    def test_runs_within_limit(self):
+        """Audio data with runs of identical values no longer than RUN_LIMIT is accepted, and read quickly.
+
+        Full-scale square waves and runs just under the limit are the worst cases for a scan that backtracks at every
+        byte of a run, so these would take seconds rather than milliseconds if the scan regressed.
+        """
+        data_block_length = sspatcher.WT_DATA_LENGTH * sspatcher.NUM_WT
+        half_wave = sspatcher.WT_DATA_LENGTH // 16  # 512 samples per wave, 2 bytes per sample, half of that
+        blocks = {
+            'square waves': (b'\xff' * half_wave + b'\x00' * half_wave) * (data_block_length // (half_wave * 2)),
+            'runs at the limit': (b'\x01' * sspatcher.RUN_LIMIT + b'\x02' * sspatcher.RUN_LIMIT) * (
+                data_block_length // (sspatcher.RUN_LIMIT * 2)
+            ),
+        }
+        for description, block in blocks.items():
+            with self.subTest(description), sspatcher_offsets(data=0):
+                wavetables = sspatcher.read_wt_data(io.BytesIO(block))
+                self.assertEqual(b''.join(wavetables), block)
+
+    def test_long_run_reported(self):
+        """The first run longer than RUN_LIMIT is reported with its full length and value."""
+        data_block_length = sspatcher.WT_DATA_LENGTH * sspatcher.NUM_WT
+        block = bytearray(random.Random(7).randbytes(data_block_length))
+        # Bracket the run with other values so its length is exact. A later, longer run of a different value shouldn't
+        # be what's reported.
+        block[999:1000 + sspatcher.RUN_LIMIT + 6] = b'\x08' + b'\x07' * (sspatcher.RUN_LIMIT + 5) + b'\x08'
+        block[50000:50000 + sspatcher.RUN_LIMIT * 2] = b'\x00' * (sspatcher.RUN_LIMIT * 2)
+        with sspatcher_offsets(data=0), self.assertRaisesRegex(
+                sspatcher.SSPatcherError, r'Found a run of {} characters \(7\)'.format(sspatcher.RUN_LIMIT + 5)
+        ) as cm:
+            sspatcher.read_wt_data(io.BytesIO(block))
+        self.assertEqual(cm.exception.args[1], sspatcher.RUN_LIMIT + 5)
+
 
 class TestReadWTNames(unittest.TestCase):
     """Tests for read_wt_names."""
-    def setUp(self):
-        self.old_name_offset = sspatcher.WT_NAME_OFFSET
-        self.old_data_offset = sspatcher.WT_DATA_OFFSET
-        self.test_image = open(REAL_TEST_IMAGE_PATH, 'rb')
 
-    def tearDown(self):
-        sspatcher.WT_NAME_OFFSET = self.old_name_offset
-        sspatcher.WT_DATA_OFFSET = self.old_data_offset
-        self.test_image.close()
+    @classmethod
+    def setUpClass(cls):
+        # Read the image once; each test gets its own in-memory file over the same bytes.
+        with open(REAL_TEST_IMAGE_PATH, 'rb') as f:
+            cls.image_bytes = f.read()
+
+    def setUp(self):
+        self.test_image = io.BytesIO(self.image_bytes)
+        self.addCleanup(self.test_image.close)
 
     def test_exceptions_from_known_bad_name_locations(self):
         """Correct exceptions are raised when reading names from locations known to cause them."""
-        sspatcher.WT_NAME_OFFSET = 0
-        with self.assertRaisesRegex(
+        with sspatcher_offsets(name=0), self.assertRaisesRegex(
                 sspatcher.SSPatcherError,
-                'Found wavetable name .+ without valid prefix\.',
+                r'Found wavetable name .+ without valid prefix\.',
                 msg="Read from known location where names don't exist didn't raise SSPatcherError."
         ):
             sspatcher.read_wt_names(self.test_image)
 
-        sspatcher.WT_NAME_OFFSET = sspatcher.IMAGE_SIZE - 64
-        with self.assertRaisesRegex(
+        with sspatcher_offsets(name=len(self.image_bytes) - 64), self.assertRaisesRegex(
                 sspatcher.SSPatcherError,
-                'Got less than .+ bytes when reading wavetable names\.',
+                r'Got less than .+ bytes when reading wavetable names\.',
                 msg="Read from known location where insufficient name data can be read didn't raise SSPatcherError."
         ):
             sspatcher.read_wt_names(self.test_image)
 
+    def test_bad_name_locations(self):
+        """SSPatcherError is raised when reading names from locations other than where the wavetable names are.
+
+        Trying every location in the image takes minutes, so this checks a fixed random sample of locations plus the
+        ones most likely to slip through: the ends of the image and locations just off the real one, including those
+        shifted by a whole name.
+        """
+        name_offset = sspatcher.WT_NAME_OFFSET
+        rng = random.Random(0xD00D)
+        image_size = len(self.image_bytes)
+        offsets = set(rng.sample(range(image_size), 4096))
+        offsets |= {
+            0, 1, image_size - 1,
+            name_offset - 1, name_offset + 1,
+            name_offset - sspatcher.WT_NAME_LENGTH, name_offset + sspatcher.WT_NAME_LENGTH
+        }
+        offsets.discard(name_offset)
+        for i in sorted(offsets):
+            with sspatcher_offsets(name=i), self.assertRaises(
+                    sspatcher.SSPatcherError,
+                    msg='Read names from location {:X} did not raise an SSPatcherError.'.format(i)
+            ):
+                sspatcher.read_wt_names(self.test_image)
+
+    @unittest.skipUnless(os.environ.get('SLOW_TESTS'), 'set SLOW_TESTS to check every location')
     def test_all_bad_name_locations(self):
         """SSPatcherError is raised when reading from everywhere except the location of the wavetable names.
 
         This test is expected to take a few minutes to run since it tries to read from every possible location.
         """
-        for i in range(0, sspatcher.IMAGE_SIZE):
-            if i != self.old_name_offset:
-                sspatcher.WT_NAME_OFFSET = i
-                with self.assertRaises(
+        name_offset = sspatcher.WT_NAME_OFFSET
+        for i in range(len(self.image_bytes)):
+            if i != name_offset:
+                with sspatcher_offsets(name=i), self.assertRaises(
                         sspatcher.SSPatcherError,
                         msg='Read names from location {:X} did not raise an SSPatcherError.'.format(i)
                 ):
@@ -137,51 +260,23 @@ class TestReadWTNames(unittest.TestCase):
 
     def test_good_name_location(self):
         """Expected wavetable names are extracted from the factory image."""
-        # List of factory wavetable names. First copied from the Shapeshifter manual, then adjusted to the names
-        # actually present in the factory image which use a couple different styles of padding with spaces to
-        # make all names exactly 8 characters.
-        factory_names = [
-            b"Basic1", b"Basic2", b"BasRec", b"BiPuls", b"BitCr1", b"BitCr2", b"BitCr3", b"BitCr4",
-            b"Buzzer", b"Cello1", b"Cello2", b"Chip 1", b"Chip 2", b"Chip 3", b"Chip 4", b"Chip 5",
-            b"Chip 6", b"Chirp1", b"Chirp2", b"Chirp3", b"Chirp4", b"Chirp5", b"Chirp6", b"Chirp7",
-            b"Chirp8", b"Chirp9", b"Chrp10", b"Chrp11", b"Chrp12", b"Chrp13", b"Chrp14", b"Chrp15",
-            b"Chrp16", b"Chrp17", b"Chrp18", b"Chrp19", b"Chrp20", b"Clrnet", b" Clav1", b" Clav2",
-            b"Dstrt1", b"Dstrt2", b"Dstrt3", b"eBass1", b"eBass2", b"eBass3", b"eBass4", b"ePian1",
-            b"ePian2", b"ePian3", b"ePian4", b"ePian5", b"Flute1", b"GapSaw", b"Grain1", b"Grain2",
-            b"Grain3", b"Gitar1", b"Gitar2", b"Gitar3", b"Gitar4", b"Harmo1", b"Harmo2", b"Harmo3",
-            b"  LFO1", b"  LFO2", b"  LFO3", b"  LFO4", b"  LFO5", b"  LFO6", b"  LFO7", b"  LFO8",
-            b"  LFO9", b" LFO10", b" LFO11", b" LFO12", b" LFO13", b" LFO14", b" LFO15", b" LFO16",
-            b" LFO17", b" LFO18", b" LFO19", b" LFO20", b" LFO21", b" Misc1", b" Misc2", b" Misc3",
-            b" Misc4", b"Noise1", b"Noise2", b"Noise3", b"Noise4", b"Noise5", b"Noise6", b" Oboes",
-            b"Ovrto1", b"Ovrto2", b"Raw  1", b"Raw  2", b"Raw  3", b"ResPls", b"ResSaw", b"ResSqu",
-            b"Saxoph", b"Symmtr", b"Thrmin", b"2Tone1", b"2Tone2", b"2Tone3", b"2Tone4", b"2Tone5",
-            b"2Tone6", b"2Tone7", b"2Tone8", b"2Tone9", b"VidGm1", b"VidGm2", b"VidGm3", b"VidGm4",
-            b"Violin", b"Vocal1", b"Vocal2", b"Vocal3", b"Vocal4", b"Vocal5", b"Vocal6", b"Vocal7"
-        ]
         names = sspatcher.read_wt_names(self.test_image)
         self.assertEqual(len(names), sspatcher.NUM_WT)
-        for i, name in enumerate(factory_names):
+        for i, name in enumerate(FACTORY_NAMES):
             self.assertEqual(names[i], name)
 
 
-class TestReadWavetablesFromFiles(unittest.TestCase):
+class TestReadWavetablesFromFiles(RandomTablesMixin, TempDirMixin, unittest.TestCase):
     """Tests for read_wavetables_from_files."""
 
-    def setUp(self):
-        self.test_image = open(REAL_TEST_IMAGE_PATH, 'rb')
-        os.mkdir(TEMP_DIRECTORY)
-
-    def tearDown(self):
-        self.test_image.close()
-        shutil.rmtree(TEMP_DIRECTORY)
-
     def test_read(self):
         """Read of factory wavetables works and matches data extracted from factory rom image."""
-        image_names = sspatcher.read_wt_names(self.test_image)
-        image_tables = sspatcher.read_wt_data(self.test_image)
+        image_names, image_tables = parse_image(REAL_TEST_IMAGE_PATH)
         wavetables = sspatcher.read_wavetables_from_files(READ_TEST_LOCATION)
         self.assertEquals(len(wavetables.keys()), len(image_names))
         self.assertEquals(len(wavetables.values()), len(image_tables))
+        # Sets so that each lookup is a hash rather than a scan comparing against every table.
+        image_names, image_tables = set(image_names), set(image_tables)
         for name, table in wavetables.items():
             self.assertIn(name, image_names)
             self.assertIn(table, image_tables)
@@ -191,6 +286,23 @@ class TestReadWavetablesFromFiles(unittest.TestCase):
         with self.assertRaisesRegex(sspatcher.SSPatcherError, "doesn't exist or isn't a directory"):
             sspatcher.read_wavetables_from_files("ajsdhfkjbvkjqebnqg")
 
+    def test_ignored_entries(self):
+        """Hidden files and directories, symlinked directories and unnumbered subdirectories aren't read."""
+        for i in range(sspatcher.NUM_WT):
+            write_file(os.path.join(self.temp_dir, 'wt{}'.format(i)), self.random_table(i))
+        write_file(os.path.join(self.temp_dir, '.DS_Store'), b'x')
+        # What macOS leaves on a FAT formatted SD card.
+        os.makedirs(os.path.join(self.temp_dir, '.Trashes', '501'))
+        write_file(os.path.join(self.temp_dir, '.Trashes', '501', 'wt0'), b'xx')
+        os.mkdir(os.path.join(self.temp_dir, 'other'))
+        write_file(os.path.join(self.temp_dir, 'other', 'wt0'), b'xx')
+        # A symlink back to the directory itself would recurse forever if followed.
+        os.symlink(self.temp_dir, os.path.join(self.temp_dir, '00'))
+        wavetables = sspatcher.read_wavetables_from_files(self.temp_dir)
+        self.assertEqual(
+            sorted(wavetables.values()), sorted(bytes(self.random_table(i)) for i in range(sspatcher.NUM_WT))
+        )
+
     def test_wrong_size(self):
         """If a file in the directory doesn't have the proper length of audio data, SSPatcherError is raised.
 
@@ -198,110 +310,153 @@ class TestReadWavetablesFromFiles(unittest.TestCase):
         sometimes and succeed other times. But this is unlikely, and the random component helps ensure that a variety
         of bad lengths are tested even though it's impossible to test every possible bad length.
         """
+        num_wt, wt_data_length = sspatcher.NUM_WT, sspatcher.WT_DATA_LENGTH
         # Make some fake wavetable files containing random data.
-        for i in range(sspatcher.NUM_WT):
-            with open(os.path.join(TEMP_DIRECTORY, 'wt{}'.format(i)), 'wb') as f:
-                f.write(os.urandom(sspatcher.WT_DATA_LENGTH))
+        for i in range(num_wt):
+            write_file(os.path.join(self.temp_dir, 'wt{}'.format(i)), self.random_table(i))
         # Overwrite each file in turn with an incorrect length of data.
-        for i in range(sspatcher.NUM_WT):
-            length = sspatcher.WT_DATA_LENGTH
-            with open(os.path.join(TEMP_DIRECTORY, 'wt{}'.format(i)), 'wb') as f:
-                while length == sspatcher.WT_DATA_LENGTH:
-                    # Twice the expected audio data size to get a roughly even distribution of too short and too long.
-                    length = random.randrange(sspatcher.WT_DATA_LENGTH * 2)
-                f.write(os.urandom(length))
-            with self.assertRaisesRegex(
-                    sspatcher.SSPatcherError,
-                    'wrong size \(expected {}, got {}\)'.format(sspatcher.WT_DATA_LENGTH, length)
-            ):
-                sspatcher.read_wavetables_from_files(TEMP_DIRECTORY)
-            # Return the file to the expected length
-            with open(os.path.join(TEMP_DIRECTORY, 'wt{}'.format(i)), 'wb') as f:
-                f.seek(0)
-                f.write(os.urandom(sspatcher.WT_DATA_LENGTH))
+        for i in range(num_wt):
+            length = wt_data_length
+            while length == wt_data_length:
+                # Twice the expected audio data size to get a roughly even distribution of too short and too long.
+                length = random.randrange(wt_data_length * 2)
+            write_file(
+                os.path.join(self.temp_dir, 'wt{}'.format(i)),
+                self.random_data[i * wt_data_length:i * wt_data_length + length]
+            )
+            with self.assertRaises(sspatcher.SSPatcherError) as cm:
+                sspatcher.read_wavetables_from_files(self.temp_dir)
+            self.assertIn('wrong size (expected {}, got {})'.format(wt_data_length, length), str(cm.exception))
+            # Return the file to the expected length. Only the size matters to read_wavetables_from_files, so truncating
+            # (which zero-fills a file that's too short) is enough.
+            os.truncate(os.path.join(self.temp_dir, 'wt{}'.format(i)), wt_data_length)
 
     def test_wrong_number_of_tables(self):
         """If there are too many or too few wavetables, SSPatcherError is raised."""
         # Could potentially test up to the OS's limit on the number of files in the directory but for the sake of
         # getting this done in a reasonable amount of time, twice as many as expected should be more than sufficient.
-        filenames = ['wt{}'.format(i) for i in range(sspatcher.NUM_WT * 2)]
-        for filename in filenames:
-            with open(os.path.join(TEMP_DIRECTORY, filename), 'wb') as f:
-                f.write(os.urandom(sspatcher.WT_DATA_LENGTH))
+        num_wt = sspatcher.NUM_WT
+        filenames = ['wt{}'.format(i) for i in range(num_wt * 2)]
+        for i, filename in enumerate(filenames):
+            write_file(os.path.join(self.temp_dir, filename), self.random_table(i))
         # Eliminate the fake wavetable files one at a time and make sure SSPatcherError is raised except when the
         # correct number of files are present.
         # Zip/range instead of enumerate here to make this robust to possible changes in the number of files tested.
         for filename, files_left in zip(filenames, range(len(filenames) - 1, -1, -1)):
-            os.remove(os.path.join(TEMP_DIRECTORY, filename))
-            if files_left != sspatcher.NUM_WT:
-                with self.assertRaisesRegex(
-                    sspatcher.SSPatcherError,
-                    'wrong number of wavetables \(expected {}, got {}\)'.format(sspatcher.NUM_WT, files_left)
-                ):
-                    sspatcher.read_wavetables_from_files(TEMP_DIRECTORY)
+            os.remove(os.path.join(self.temp_dir, filename))
+            if files_left != num_wt:
+                with self.assertRaises(sspatcher.SSPatcherError) as cm:
+                    sspatcher.read_wavetables_from_files(self.temp_dir)
+                self.assertIn(
+                    'wrong number of wavetables (expected {}, got {})'.format(num_wt, files_left), str(cm.exception)
+                )
 
     def test_duplicate_names(self):
         """If there are some filenames that result in duplicate wavetable names, SSPatcherError is raised."""
         for i in range(sspatcher.NUM_WT):
-            with open(os.path.join(TEMP_DIRECTORY, '{}wtwtwt'.format(i)), 'wb') as f:
-                f.write(os.urandom(sspatcher.WT_DATA_LENGTH))
+            write_file(os.path.join(self.temp_dir, '{}wtwtwt'.format(i)), self.random_table(i))
         with self.assertRaisesRegex(sspatcher.SSPatcherError, 'Duplicate name .+wtwtwt.+ in wavetable names'):
-            sspatcher.read_wavetables_from_files(TEMP_DIRECTORY)
+            sspatcher.read_wavetables_from_files(self.temp_dir)
 
 
-class TestCheckImageSize(unittest.TestCase):
+class TestCheckImageSize(TempDirMixin, unittest.TestCase):
     """Tests for check_image_size."""
 
-    FAKE_IMAGE_PATH = "checkimage.bin"
-
     def test_valid_image(self):
         sspatcher.check_image_size(REAL_TEST_IMAGE_PATH)
 
     def test_invalid_images(self):
-        fake_sizes = [sspatcher.IMAGE_SIZE + 1, sspatcher.IMAGE_SIZE - 1, 0, 1, 0x200000, 0x400000]
-        self.addCleanup(functools.partial(os.remove, self.FAKE_IMAGE_PATH))
+        fake_image_path = os.path.join(self.temp_dir, 'checkimage.bin')
+        fake_sizes = [
+            sspatcher.IMAGE_SIZE_SHORT + 1, sspatcher.IMAGE_SIZE_SHORT - 1,
+            sspatcher.IMAGE_SIZE_LONG + 1, sspatcher.IMAGE_SIZE_LONG - 1,
+            0, 1, 0x400000
+        ]
         for size in fake_sizes:
-            with open(self.FAKE_IMAGE_PATH, 'wb') as f:
-                f.write(os.urandom(size))
-            self.assertRaisesRegex(
-                sspatcher.SSPatcherError,
-                'had unexpected size \(got {}, expected {}\).'.format(size, sspatcher.IMAGE_SIZE)
-            )
+            with self.subTest(size=size):
+                # check_image_size only looks at the size of the file, so its contents can be left as zeros.
+                with open(fake_image_path, 'wb') as f:
+                    f.truncate(size)
+                with self.assertRaisesRegex(sspatcher.SSPatcherError, r'had unexpected size \(got {}, '.format(size)):
+                    sspatcher.check_image_size(fake_image_path)
 
 
-class TestExtract(unittest.TestCase):
+class TestExtract(TempDirMixin, unittest.TestCase):
     """Tests for extract."""
 
-    def setUp(self):
-        self.test_image = open(REAL_TEST_IMAGE_PATH, 'rb')
-
-    def tearDown(self):
-        self.test_image.close()
-
     def test_extract(self):
         """Full extraction process works - names and data are read and files are written successfully.
 
         This is expected to fail if the names or wavetable data aren't successfully read from the image.
         """
-        self.addCleanup(functools.partial(shutil.rmtree, TEMP_DIRECTORY))
-        names = sspatcher.read_wt_names(self.test_image)
-        tables = sspatcher.read_wt_data(self.test_image)
-        sspatcher.extract(REAL_TEST_IMAGE_PATH, TEMP_DIRECTORY)
-        filenames = os.listdir(TEMP_DIRECTORY)
+        destination = os.path.join(self.temp_dir, 'tables')
+        names, tables = parse_image(REAL_TEST_IMAGE_PATH)
+        sspatcher.extract(REAL_TEST_IMAGE_PATH, destination)
+        filenames = os.listdir(destination)
         self.assertEquals(len(names), len(filenames))
         self.assertEquals(len(tables), len(filenames))
+        # Sets so that each lookup is a hash rather than a scan comparing against every table.
+        names, tables = set(names), set(tables)
         for filename in filenames:
             name = filename[:sspatcher.WT_USER_NAME_LENGTH]
             self.assertIn(name.encode(), names)
-            with open('{}/{}'.format(TEMP_DIRECTORY, filename), 'rb') as f:
+            with open(os.path.join(destination, filename), 'rb') as f:
                 self.assertIn(f.read(), tables)
 
+    def test_extract_subdirs(self):
+        """Extracting into subdirectories splits the files evenly in image order, and the result can be patched back."""
+        destination = os.path.join(self.temp_dir, 'tables')
+        names, tables = parse_image(REAL_TEST_IMAGE_PATH)
+        sspatcher.extract(REAL_TEST_IMAGE_PATH, destination, subdirs=8)
+        self.assertEqual(sorted(os.listdir(destination)), ['{:02d}'.format(i) for i in range(8)])
+        for i, directory in enumerate(sorted(os.listdir(destination))):
+            filenames = os.listdir(os.path.join(destination, directory))
+            self.assertEqual(len(filenames), 16)
+            self.assertEqual(set(filenames), {name.decode() + '.raw' for name in names[i * 16:(i + 1) * 16]})
+
+        # Patching reads the files back out of the subdirectories.
+        patched_image_path = os.path.join(self.temp_dir, 'patchedimage.bin')
+        shutil.copyfile(REAL_TEST_IMAGE_PATH, patched_image_path)
+        sspatcher.patch(destination, patched_image_path)
+        patched_names, patched_tables = parse_image(patched_image_path)
+        self.assertEqual(dict(zip(patched_names, patched_tables)), dict(zip(names, tables)))
+
+    def test_extract_bad_subdirs(self):
+        """Numbers of subdirectories that can't hold an equal share of the wavetables are rejected."""
+        destination = os.path.join(self.temp_dir, 'tables')
+        for subdirs in (0, 3, 100, sspatcher.NUM_WT * 2):
+            with self.subTest(subdirs=subdirs):
+                with self.assertRaisesRegex(sspatcher.SSPatcherError, 'divide it evenly'):
+                    sspatcher.extract(REAL_TEST_IMAGE_PATH, destination, subdirs=subdirs)
+                self.assertFalse(os.path.exists(destination))
+
     def test_extract_doesnt_overwrite(self):
         """Full extraction fails if the destination directory already exists."""
-        self.addCleanup(functools.partial(shutil.rmtree, TEMP_DIRECTORY))
-        os.mkdir(TEMP_DIRECTORY)
         with self.assertRaisesRegex(sspatcher.SSPatcherError, 'already exists'):
-            sspatcher.extract(REAL_TEST_IMAGE_PATH, TEMP_DIRECTORY)
+            sspatcher.extract(REAL_TEST_IMAGE_PATH, self.temp_dir)
+
+    def test_extract_wav(self):
+        """Wav copies of the wavetables are written alongside the destination as mono 16 bit audio."""
+        destination = os.path.join(self.temp_dir, 'tables')
+        names, tables = parse_image(REAL_TEST_IMAGE_PATH)
+        sspatcher.extract(REAL_TEST_IMAGE_PATH, destination)
+        wav_directory = destination + '_wav'
+        self.assertEqual(len(os.listdir(wav_directory)), sspatcher.NUM_WT)
+        with wave.open(os.path.join(wav_directory, names[0].decode() + '.wav'), 'rb') as f:
+            self.assertEqual(f.getnchannels(), 1)
+            self.assertEqual(f.getsampwidth(), 2)
+            self.assertEqual(f.getframerate(), 44100)
+            self.assertEqual(f.getnframes(), sspatcher.WT_DATA_LENGTH // 2)
+            self.assertEqual(f.readframes(f.getnframes()), tables[0])
+
+    def test_extract_doesnt_overwrite_wav(self):
+        """Full extraction fails, without writing anything, if the wav directory already exists."""
+        destination = os.path.join(self.temp_dir, 'tables')
+        os.mkdir(destination + '_wav')
+        with self.assertRaisesRegex(sspatcher.SSPatcherError, 'tables_wav already exists'):
+            sspatcher.extract(REAL_TEST_IMAGE_PATH, destination)
+        self.assertFalse(os.path.exists(destination))
+        self.assertEqual(os.listdir(destination + '_wav'), [])
 
 
 class TestSanitizeName(unittest.TestCase):
@@ -320,62 +475,139 @@ class TestSanitizeName(unittest.TestCase):
             'test 1': b'test 1',
             '': b'      ',
             ' ': b'      ',
-            'verylongname': b'ngname'
+            'verylongname': b'ngname',
+            # Whitespace str.strip removes, but that isn't ASCII or a space, is stripped before truncating.
+            'abcdefg\xa0': b'bcdefg',
+            'abcdefg\x1f': b'bcdefg',
         }
         for name, expected in test_data.items():
             self.assertEquals(sspatcher.sanitize_name(name), expected)
 
     def test_valid_chars(self):
         """All valid characters are accepted."""
-        # This builds the list of valid characters to check the same way the constant does, so this should really
-        # never fail unless something is horribly wrong or the constant changes.
-        chars_to_check = string.ascii_letters + string.digits + ' '
-
-        # Helper function to get chunks of characters from the string containing the allowed ones.
-        def group(s, n):
-            for item in itertools.zip_longest(*[iter(s)] * n, fillvalue=' '):
-                yield ''.join(item)
-
-        for name in group(chars_to_check, sspatcher.WT_USER_NAME_LENGTH):
+        for name in VALID_NAME_CHUNKS:
             self.assertEquals(sspatcher.sanitize_name(name), name.encode())
 
     def test_invalid_chars(self):
+        """A sample of invalid characters is rejected.
+
+        The sample is a fixed random selection of all the invalid characters, plus those on either side of the
+        allowed ranges and at the ends of the ASCII, Latin-1, BMP and Unicode ranges. test_all_invalid_chars checks
+        every character but is slow.
+        """
+        allowed = frozenset(sspatcher.ALLOWED_CHARS)
+        rejected = [ch for ch in map(chr, range(MAX_UNICODE_CHAR + 1)) if ch not in allowed]
+        edge_chars = ['\x00', '\x1f', '!', '/', ':', '@', '[', '`', '{', '\x7f', '\x80', '\xff', '\uffff', '\U0010ffff']
+        for ch in random.Random(1).sample(rejected, 2048) + edge_chars:
+            with self.assertRaisesRegex(sspatcher.SSPatcherError, INVALID_CHARACTER_PATTERN):
+                sspatcher.sanitize_name(ch)
+
+    def test_invalid_char_reported(self):
+        """The invalid character reported is one that's still in the name after truncating it."""
+        with self.assertRaisesRegex(sspatcher.SSPatcherError, r'\(abcde\.\) contains invalid character \(\.\)'):
+            sspatcher.sanitize_name('!abcde.')
+
+    @unittest.skipUnless(os.environ.get('SLOW_TESTS'), 'set SLOW_TESTS to check every character')
+    def test_all_invalid_chars(self):
         """All invalid characters are rejected."""
-        max_unicode_char = 0x10FFFF
-        for ch in (chr(i) for i in range(max_unicode_char + 1)):
+        for ch in (chr(i) for i in range(MAX_UNICODE_CHAR + 1)):
             if ch not in sspatcher.ALLOWED_CHARS:
-                with self.assertRaisesRegex(sspatcher.SSPatcherError, 'invalid character'):
+                with self.assertRaisesRegex(sspatcher.SSPatcherError, INVALID_CHARACTER_PATTERN):
                     sspatcher.sanitize_name(ch)
 
 
-class TestPatch(unittest.TestCase):
-
-    PATCHED_IMAGE_PATH = "patchedimage.bin"
+class TestPatch(RandomTablesMixin, TempDirMixin, unittest.TestCase):
 
     def test_success(self):
         """Verify that a copy of the rom image is patched using test data."""
-        self.addCleanup(functools.partial(os.remove, self.PATCHED_IMAGE_PATH))
-        self.addCleanup(functools.partial(shutil.rmtree, TEMP_DIRECTORY))
-        os.mkdir(TEMP_DIRECTORY)
+        tables_directory = os.path.join(self.temp_dir, 'tables')
+        patched_image_path = os.path.join(self.temp_dir, 'patchedimage.bin')
+        os.mkdir(tables_directory)
         # Generate some fake wavetables using random data
         for i in range(sspatcher.NUM_WT):
-            with open(os.path.join(TEMP_DIRECTORY, 'wt{}.raw'.format(i)), 'wb') as f:
-                f.write(os.urandom(sspatcher.WT_DATA_LENGTH))
+            write_file(os.path.join(tables_directory, 'wt{}.raw'.format(i)), self.random_table(i))
 
         # Make a copy of the test imgae and patch it
-        shutil.copyfile(REAL_TEST_IMAGE_PATH, self.PATCHED_IMAGE_PATH)
-        sspatcher.patch(TEMP_DIRECTORY, self.PATCHED_IMAGE_PATH)
+        shutil.copyfile(REAL_TEST_IMAGE_PATH, patched_image_path)
+        sspatcher.patch(tables_directory, patched_image_path)
 
         # Verify that what we read from the ROM image is the same as what's in the test data.
-        with open(self.PATCHED_IMAGE_PATH, 'rb') as f:
+        with open(patched_image_path, 'rb') as f:
             names = sspatcher.read_wt_names(f)
             tables = sspatcher.read_wt_data(f)
-        filenames = {os.path.splitext(name)[0].rjust(6).encode(): name for name in os.listdir(TEMP_DIRECTORY)}
+        filenames = {os.path.splitext(name)[0].rjust(6).encode(): name for name in os.listdir(tables_directory)}
         for name, table in zip(names, tables):
             self.assertIn(name, filenames.keys())
-            with open(os.path.join(TEMP_DIRECTORY, filenames[name]), 'rb') as f:
+            with open(os.path.join(tables_directory, filenames[name]), 'rb') as f:
                 self.assertEqual(table, f.read())
 
 
+
+class TestWriteIhex(unittest.TestCase):
+    """Tests for _write_ihex."""
+
+    def write(self, data, offset):
+        out = io.StringIO()
+        sspatcher._write_ihex(out, data, offset)
+        return out.getvalue()
+
+    def test_small_block(self):
+        """A block below 64 KB is written as data records without extended addresses, then the end of file record."""
+        self.assertEqual(self.write(bytes(range(4)), 0), ':0400000000010203F6\n:00000001FF\n')
+
+    def test_unaligned_segment_boundary(self):
+        """A block that crosses a 64 KB boundary part way through a record gets an extended address at the boundary."""
+        self.assertEqual(
+            self.write(bytes(range(0x20)), 0xFFF5),
+            ':020000040000FA\n'
+            ':0BFFF500000102030405060708090ACA\n'
+            ':020000040001F9\n'
+            ':100000000B0C0D0E0F101112131415161718191AC8\n'
+            ':050010001B1C1D1E1F5A\n'
+            ':00000001FF\n'
+        )
+
+    def test_segments(self):
+        """Every record checksums correctly and an extended address record starts each 64 KB segment."""
+        offset = 0xFFF5
+        data = random.Random(3).randbytes(0x30000)
+        text = self.write(data, offset)
+        self.assertEqual(parse_ihex(text), (offset, data))
+        lines = text.splitlines()
+        self.assertEqual(lines[-1], ':00000001FF')
+        extended = [(i, line) for i, line in enumerate(lines) if line[7:9] == '04']
+        self.assertEqual([line[9:13] for _, line in extended], ['0000', '0001', '0002', '0003'])
+        for i, line in extended[1:]:
+            # Each segment after the first starts with a data record at address 0.
+            self.assertEqual(lines[i + 1][3:9], '000000')
+
+
+class TestDeriveNames(RandomTablesMixin, TempDirMixin, unittest.TestCase):
+    """Tests for derive_names."""
+
+    def test_success(self):
+        """The names and wavetables are written to hex files at the locations they occupy in the ROM image."""
+        source = os.path.join(self.temp_dir, 'tables')
+        os.mkdir(source)
+        # Zero padded so that the order the names are sorted in is the order they're written in.
+        for i in range(sspatcher.NUM_WT):
+            write_file(os.path.join(source, 'wt{:03d}.raw'.format(i)), self.random_table(i))
+        sspatcher.derive_names(source)
+
+        with open(source + '_names.hex') as f:
+            self.assertEqual(
+                parse_ihex(f.read()),
+                (
+                    sspatcher.WT_NAME_OFFSET,
+                    b''.join(sspatcher.WT_NAME_PREFIX + ' wt{:03d}'.format(i).encode() for i in range(sspatcher.NUM_WT))
+                )
+            )
+        with open(source + '_waves.hex') as f:
+            self.assertEqual(
+                parse_ihex(f.read()),
+                (sspatcher.WT_DATA_OFFSET, b''.join(self.random_table(i) for i in range(sspatcher.NUM_WT)))
+            )
+
+
 if __name__ == '__main__':
     unittest.main()